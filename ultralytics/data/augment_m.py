@@ -159,7 +159,7 @@ class Mosaic_m(BaseMixTransform_m):
     def get_indexes(self, buffer=True):
         """Return a list of random indexes from the dataset."""
         if buffer:  # select images from buffer
-            return random.choices(list(self.dataset.buffer_rgb), k=self.n - 1)
+            return random.choices(list(self.dataset.buffer), k=self.n - 1)
         else:  # select any images
             return [random.randint(0, len(self.dataset) - 1) for _ in range(self.n - 1)]
 
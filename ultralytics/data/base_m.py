@@ -1,10 +1,14 @@
 # Ultralytics YOLO 🚀, AGPL-3.0 license
 
-import glob
+import contextlib
 import math
 import os
 import random
-from copy import deepcopy
+import re
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from typing import Optional
@@ -12,10 +16,11 @@ from typing import Optional
 import cv2
 import numpy as np
 import psutil
-from torch.utils.data import Dataset
+from PIL import Image
+from torch.utils.data import Dataset, get_worker_info
 
-from ultralytics.utils import DEFAULT_CFG, LOCAL_RANK, LOGGER, NUM_THREADS, TQDM
-from .utils import HELP_URL, IMG_FORMATS
+from ultralytics.utils import DEFAULT_CFG, LOCAL_RANK, LOGGER, NUM_THREADS, TQDM, is_dir_writeable
+from .utils import HELP_URL, IMG_FORMATS_SET, exif_size, get_hash, scan_files
 
 
 class BaseDataset_m(Dataset):
@@ -41,8 +46,14 @@ class BaseDataset_m(Dataset):
         im_files (list): List of image file paths.
         labels (list): List of label data dictionaries.
         ni (int): Number of images in the dataset.
-        ims (list): List of loaded images.
-        npy_files (list): List of numpy file paths.
+        ims_rgb (np.ndarray): Per-process (slots, imgsz, imgsz, 3) uint8 store of loaded RGB images.
+        ims_ir (np.ndarray): Per-process (slots, imgsz, imgsz, 3) uint8 store of loaded IR images, resized to the
+            shape of their RGB pair.
+        im_hw (np.ndarray): (slots, 4) int32 table of (h0, w0, h, w), original and resized shape of each stored pair.
+        slots (dict): Dataset index to slot of the images stored in ims_rgb, ims_ir and im_hw.
+        blob_file_rgb (Path): Packed RGB disk cache, one (imgsz, imgsz, 3) uint8 tile per image in sorted file order,
+            named by the hash of the image set.
+        blob_file_ir (Path): Packed IR disk cache, one (imgsz, imgsz, 3) uint8 tile per image, named likewise.
         transforms (callable): Image transformation function.
     """
 
@@ -89,20 +100,24 @@ class BaseDataset_m(Dataset):
             self.set_rectangle()
 
         # Buffer thread for mosaic images
-        self.buffer_rgb = []  # buffer size = batch size
-        self.buffer_ir = []  # buffer size = batch size
         self.max_buffer_length = min((self.ni, self.batch_size * 8, 1000)) if self.augment else 0
+        self.buffer = deque(maxlen=self.max_buffer_length)  # buffer size = batch size, shared by RGB and IR
+        self._pool, self._pool_pid = None, None  # per-process I/O thread pool
+        self._prefetch, self._last_index = None, -1  # (index, Future) of the pair decoded ahead of __getitem__
 
         # Cache images
+        cache = "ram" if cache is True else cache  # True is an alias of 'ram'
         if cache == "ram" and not self.check_cache_ram():
             cache = False
-        self.ims_rgb, self.im_hw0_rgb, self.im_hw_rgb = [None] * self.ni, [None] * self.ni, [None] * self.ni
-        self.npy_files_rgb = [Path(f).with_suffix(".npy") for f in self.im_files_rgb]
-        self.ims_ir, self.im_hw0_ir, self.im_hw_ir = [None] * self.ni, [None] * self.ni, [None] * self.ni
-        self.npy_files_ir = [Path(f).with_suffix(".npy") for f in self.im_files_ir]
+        self.cache = cache
+        self.max_slots = self.ni if cache == "ram" else self.max_buffer_length  # one per image or per buffered pair
+        self.ims_rgb, self.ims_ir, self.im_hw = None, None, None  # allocated on first store by _alloc_slots()
+        self.slots = {}  # dataset index -> slot
+        self.blob_file_rgb, self.blob_file_ir = None, None  # set by cache_images('disk')
+        self.blob_rows = None  # dataset index -> packed disk cache row, set by cache_images('disk')
+        self.blob_rgb, self.blob_hw_rgb, self.blob_ir, self.blob_hw_ir = None, None, None, None
         if cache:
-            self.cache_images_rgb(cache)
-            self.cache_images_ir(cache)
+            self.cache_images(cache)
 
         # Transforms
         self.transforms = self.build_transforms(hyp=hyp)
@@ -114,7 +129,7 @@ class BaseDataset_m(Dataset):
             for p in img_path if isinstance(img_path, list) else [img_path]:
                 p = Path(p)  # os-agnostic
                 if p.is_dir():  # dir
-                    f += glob.glob(str(p / "**" / "*.*"), recursive=True)
+                    f += scan_files(str(p))
                     # F = list(p.rglob('*.*'))  # pathlib
                 elif p.is_file():  # file
                     with open(p) as t:
@@ -124,7 +139,9 @@ class BaseDataset_m(Dataset):
                         # F += [p.parent / x.lstrip(os.sep) for x in t]  # local to global path (pathlib)
                 else:
                     raise FileNotFoundError(f"{prefix}{p} does not exist")
-            im_files = sorted(x.replace("/", os.sep) for x in f if x.split(".")[-1].lower() in IMG_FORMATS)
+            im_files = sorted(
+                x.replace("/", os.sep) for x in f if os.path.splitext(x)[1][1:].lower() in IMG_FORMATS_SET
+            )
             # self.img_files = sorted([x for x in f if x.suffix[1:].lower() in IMG_FORMATS])  # pathlib
             assert im_files, f"{prefix}No images found in {img_path}"
         except Exception as e:
@@ -135,164 +152,265 @@ class BaseDataset_m(Dataset):
 
     def update_labels(self, include_class: Optional[list]):
         """Update labels to include only these classes (optional)."""
-        include_class_array = np.array(include_class).reshape(1, -1)
-        for i in range(len(self.labels_rgb)):
-            if include_class is not None:
-                cls = self.labels_rgb[i]["cls"]
-                bboxes = self.labels_rgb[i]["bboxes"]
-                segments = self.labels_rgb[i]["segments"]
-                keypoints = self.labels_rgb[i]["keypoints"]
-                j = (cls == include_class_array).any(1)
-                self.labels_rgb[i]["cls"] = cls[j]
-                self.labels_rgb[i]["bboxes"] = bboxes[j]
-                if segments:
-                    self.labels_rgb[i]["segments"] = [segments[si] for si, idx in enumerate(j) if idx]
-                if keypoints is not None:
-                    self.labels_rgb[i]["keypoints"] = keypoints[j]
-            if self.single_cls:
-                self.labels_rgb[i]["cls"][:, 0] = 0
-        for i in range(len(self.labels_ir)):
-            if include_class is not None:
-                cls = self.labels_ir[i]["cls"]
-                bboxes = self.labels_ir[i]["bboxes"]
-                segments = self.labels_ir[i]["segments"]
-                keypoints = self.labels_ir[i]["keypoints"]
-                j = (cls == include_class_array).any(1)
-                self.labels_ir[i]["cls"] = cls[j]
-                self.labels_ir[i]["bboxes"] = bboxes[j]
-                if segments:
-                    self.labels_ir[i]["segments"] = [segments[si] for si, idx in enumerate(j) if idx]
-                if keypoints is not None:
-                    self.labels_ir[i]["keypoints"] = keypoints[j]
+        if include_class is None and not self.single_cls:
+            return  # nothing to filter or remap
+        for labels in (self.labels_rgb, self.labels_ir):
+            if include_class is not None and labels:
+                offsets = np.cumsum([len(lb["cls"]) for lb in labels])[:-1]  # per-image split points
+                keep = np.isin(np.concatenate([lb["cls"] for lb in labels])[:, 0], include_class)
+                for lb, j in zip(labels, np.split(keep, offsets)):
+                    if j.all():
+                        continue
+                    lb["cls"] = lb["cls"][j]
+                    lb["bboxes"] = lb["bboxes"][j]
+                    if lb["segments"]:
+                        lb["segments"] = [s for s, k in zip(lb["segments"], j) if k]
+                    if lb["keypoints"] is not None:
+                        lb["keypoints"] = lb["keypoints"][j]
             if self.single_cls:
-                self.labels_ir[i]["cls"][:, 0] = 0
-
-    def load_image_rgb(self, i, rect_mode=True):
-        """Loads 1 image from dataset index 'i', returns (im, resized hw)."""
-        im, f, fn = self.ims_rgb[i], self.im_files_rgb[i], self.npy_files_rgb[i]
-        if im is None:  # not cached in RAM
-            if fn.exists():  # load npy
-                try:
-                    im = np.load(fn)
-                except Exception as e:
-                    LOGGER.warning(f"{self.prefix_rgb}WARNING ⚠️ Removing corrupt *.npy image file {fn} due to: {e}")
-                    Path(fn).unlink(missing_ok=True)
-                    im = cv2.imread(f)  # BGR
-            else:  # read image
-                im = cv2.imread(f)  # BGR
-            if im is None:
-                raise FileNotFoundError(f"Image Not Found {f}")
-
-            h0, w0 = im.shape[:2]  # orig hw
-            if rect_mode:  # resize long side to imgsz while maintaining aspect ratio
-                r = self.imgsz / max(h0, w0)  # ratio
-                if r != 1:  # if sizes are not equal
-                    w, h = (min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz))
-                    im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
-            elif not (h0 == w0 == self.imgsz):  # resize by stretching image to square imgsz
-                im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
-
-            # Add to buffer if training with augmentations
-            if self.augment:
-                self.ims_rgb[i], self.im_hw0_rgb[i], self.im_hw_rgb[i] = im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
-                self.buffer_rgb.append(i)
-                if len(self.buffer_rgb) >= self.max_buffer_length:
-                    j = self.buffer_rgb.pop(0)
-                    self.ims_rgb[j], self.im_hw0_rgb[j], self.im_hw_rgb[j] = None, None, None
-
-            return im, (h0, w0), im.shape[:2]
-
-        return self.ims_rgb[i], self.im_hw0_rgb[i], self.im_hw_rgb[i]
-
-    def cache_images_rgb(self, cache):
-        """Cache images to memory or disk."""
-        b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-        fcn = self.cache_images_to_disk_rgb if cache == "disk" else self.load_image_rgb
-        with ThreadPool(NUM_THREADS) as pool:
-            results = pool.imap(fcn, range(self.ni))
-            pbar = TQDM(enumerate(results), total=self.ni, disable=LOCAL_RANK > 0)
-            for i, x in pbar:
-                if cache == "disk":
-                    b += self.npy_files_rgb[i].stat().st_size
-                else:  # 'ram'
-                    self.ims_rgb[i], self.im_hw0_rgb[i], self.im_hw_rgb[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    b += self.ims_rgb[i].nbytes
-                pbar.desc = f"{self.prefix_rgb}Caching images ({b / gb:.1f}GB {cache})"
-            pbar.close()
-
-    def cache_images_to_disk_rgb(self, i):
-        """Saves an image as an *.npy file for faster loading."""
-        f = self.npy_files_rgb[i]
-        if not f.exists():
-            np.save(f.as_posix(), cv2.imread(self.im_files_rgb[i]), allow_pickle=False)
-
-    def load_image_ir(self, i, rect_mode=True):
-        """Loads 1 image from dataset index 'i', returns (im, resized hw)."""
-        im, f, fn = self.ims_ir[i], self.im_files_ir[i], self.npy_files_ir[i]
-        if im is None:  # not cached in RAM
-            if fn.exists():  # load npy
-                try:
-                    im = np.load(fn)
-                except Exception as e:
-                    LOGGER.warning(f"{self.prefix_ir}WARNING ⚠️ Removing corrupt *.npy image file {fn} due to: {e}")
-                    Path(fn).unlink(missing_ok=True)
-                    im = cv2.imread(f)  # BGR
-            else:  # read image
-                im = cv2.imread(f)  # BGR
-            if im is None:
-                raise FileNotFoundError(f"Image Not Found {f}")
-
-            h0, w0 = im.shape[:2]  # orig hw
-            if rect_mode:  # resize long side to imgsz while maintaining aspect ratio
-                r = self.imgsz / max(h0, w0)  # ratio
-                if r != 1:  # if sizes are not equal
-                    w, h = (min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz))
-                    im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
-            elif not (h0 == w0 == self.imgsz):  # resize by stretching image to square imgsz
-                im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
-
-            # Add to buffer if training with augmentations
-            if self.augment:
-                self.ims_ir[i], self.im_hw0_ir[i], self.im_hw_ir[i] = im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
-                self.buffer_ir.append(i)
-                if len(self.buffer_ir) >= self.max_buffer_length:
-                    j = self.buffer_ir.pop(0)
-                    self.ims_ir[j], self.im_hw0_ir[j], self.im_hw_ir[j] = None, None, None
-
-            return im, (h0, w0), im.shape[:2]
-
-        return self.ims_ir[i], self.im_hw0_ir[i], self.im_hw_ir[i]
+                for lb in labels:
+                    lb["cls"][:, 0] = 0  # in place, bboxes, segments and keypoints are untouched
+
+    def load_pair(self, i, rect_mode=True):
+        """Loads the RGB and IR images of dataset index 'i', returns (im_rgb, im_ir, hw_original, hw_resized)."""
+        s = self.slots.get(i)
+        if s is not None:  # cached in RAM
+            h0, w0, h, w = self.im_hw[s].tolist()
+            return self.ims_rgb[s, :h, :w], self.ims_ir[s, :h, :w], (h0, w0), (h, w)
+
+        if self.blob_hw_rgb is not None and self.blob_rgb is None:  # dropped when pickled to this worker
+            try:
+                self._map_blobs()
+            except (OSError, ValueError):  # removed as stale by a dataset over another image set, decode instead
+                self.blob_hw_rgb, self.blob_hw_ir = None, None
+        if self.blob_hw_rgb is not None:  # packed disk cache
+            im_rgb, hw0, hw = self._read_blob(self.blob_rgb, self.blob_hw_rgb, i, rect_mode)
+            im_ir = self._resize(self._read_blob(self.blob_ir, self.blob_hw_ir, i, rect_mode)[0], hw)  # match RGB
+        else:
+            if self._prefetch is not None and self._prefetch[0] == i:  # decoded ahead by _prefetch_next()
+                im_rgb, im_ir, hw0 = self._prefetch[1].result()
+                self._prefetch = None
+            else:
+                size = self.imgsz if rect_mode else None  # reduced JPEG decodes only preserve the long side
+                # overlap IR and RGB reads
+                ir = self._io_pool().submit(self._imread, self.im_files_ir[i], size, self.labels_ir[i].get("shape"))
+                im_rgb, hw0 = self._imread(self.im_files_rgb[i], size, self.labels_rgb[i].get("shape"))
+                im_ir = ir.result()[0]
+            im_rgb, im_ir, hw0, hw = self._resize_pair(im_rgb, im_ir, hw0, rect_mode)
+
+        # Add to buffer if training with augmentations
+        if self.augment:
+            if len(self.buffer) == self.buffer.maxlen:  # full, evict the oldest pair and reuse its slot
+                s = self.slots.pop(self.buffer.popleft())
+            else:
+                s = len(self.slots)
+            self._store(s, im_rgb, im_ir, hw0, hw)
+            self.slots[i] = s
+            self.buffer.append(i)
+
+        return im_rgb, im_ir, hw0, hw
+
+    def _store(self, s, im_rgb, im_ir, hw0, hw):
+        """Copies a resized RGB/IR pair and its shapes into slot 's'."""
+        if self.ims_rgb is None:
+            self._alloc_slots()
+        h, w = hw
+        self.ims_rgb[s, :h, :w], self.ims_ir[s, :h, :w], self.im_hw[s] = im_rgb, im_ir, (*hw0, h, w)
+
+    def _alloc_slots(self):
+        """Allocates this process' image slots, their pages are only committed once written."""
+        shape = (self.max_slots, self.imgsz, self.imgsz, 3)
+        self.ims_rgb, self.ims_ir = np.empty(shape, np.uint8), np.empty(shape, np.uint8)
+        self.im_hw = np.zeros((self.max_slots, 4), np.int32)  # (h0, w0, h, w) of each slot, shared by RGB and IR
+
+    def _prefetch_next(self, index):
+        """Starts decoding pair 'index + 1' in the background when a DataLoader worker reads indices sequentially."""
+        sequential, self._last_index = index == self._last_index + 1, index
+        i = index + 1
+        if not sequential or i >= self.ni or i in self.slots or self.blob_hw_rgb is not None:
+            return  # shuffled access, end of dataset or already cached
+        if get_worker_info() is None:
+            return  # main process, a read in flight at fork time could deadlock DataLoader workers
+        if self._prefetch is None or self._prefetch[1].done():  # at most one pair in flight
+            self._prefetch = i, self._io_pool().submit(self._read_pair, i, self.imgsz)
+
+    def _read_pair(self, i, size=None):
+        """Decodes the RGB and IR images of index 'i' without resizing or buffering, returns (im_rgb, im_ir, hw0)."""
+        im_rgb, hw0 = self._imread(self.im_files_rgb[i], size, self.labels_rgb[i].get("shape"))
+        return im_rgb, self._imread(self.im_files_ir[i], size, self.labels_ir[i].get("shape"))[0], hw0
+
+    def _io_pool(self):
+        """Returns this process' I/O thread pool, its threads are joined at exit so workers never exit mid-decode."""
+        if self._pool_pid != os.getpid():
+            self._pool, self._pool_pid, self._prefetch = ThreadPoolExecutor(2), os.getpid(), None
+        return self._pool
+
+    def __getstate__(self):
+        """Drops per-process state when the dataset is pickled to DataLoader workers, which rebuild it lazily."""
+        state = self.__dict__.copy()
+        state["_pool"], state["_pool_pid"], state["_prefetch"] = None, None, None
+        state["blob_rgb"], state["blob_ir"] = None, None  # pickling a memmap copies the whole file, re-map instead
+        if self.cache != "ram":  # mosaic buffer slots are private to each worker, start empty
+            state["ims_rgb"], state["ims_ir"], state["im_hw"], state["slots"] = None, None, None, {}
+            state["buffer"] = deque(maxlen=self.max_buffer_length)
+        return state
+
+    @staticmethod
+    def _imread(f, size=None, shape=None):
+        """
+        Decodes image file 'f' as BGR, returns (im, hw_original).
 
-    def cache_images_ir(self, cache):
-        """Cache images to memory or disk."""
+        JPEGs whose (h, w) 'shape' recorded in the labels has a long side of at least 2x 'size' are decoded at 1/2, 1/4
+        or 1/8 scale inside libjpeg's IDCT, choosing the smallest scale that keeps the long side >= 'size', so only the
+        residual is resized afterwards. No header is read, smaller images go straight to a full decode.
+        """
+        if size and shape and os.path.splitext(f)[1].lower() in {".jpg", ".jpeg"}:
+            h0, w0 = shape
+            for s in 8, 4, 2:
+                if math.ceil(max(h0, w0) / s) >= size:
+                    im = cv2.imread(f, getattr(cv2, f"IMREAD_REDUCED_COLOR_{s}"))
+                    if im is not None and im.shape[:2] == (math.ceil(h0 / s), math.ceil(w0 / s)):
+                        return im, (h0, w0)
+                    break  # unexpected shape, e.g. a stale label cache or an EXIF transpose, decode at full scale
+        im = cv2.imread(f)  # BGR
+        if im is None:
+            raise FileNotFoundError(f"Image Not Found {f}")
+        return im, im.shape[:2]
+
+    @staticmethod
+    def _imsize(f):
+        """Returns the EXIF-corrected (w, h) of image file 'f' from its header, closing the file."""
+        with Image.open(f) as im:
+            return exif_size(im)
+
+    def _resized_shape(self, h0, w0, rect_mode=True):
+        """Returns the resized (h, w) of an image with original shape (h0, w0)."""
+        if rect_mode:  # resize long side to imgsz while maintaining aspect ratio
+            r = self.imgsz / max(h0, w0)  # ratio
+            return (min(math.ceil(h0 * r), self.imgsz), min(math.ceil(w0 * r), self.imgsz)) if r != 1 else (h0, w0)
+        return self.imgsz, self.imgsz  # resize by stretching image to square imgsz
+
+    @staticmethod
+    def _resize(im, hw):
+        """Resizes image 'im' to shape (h, w) if it differs."""
+        return im if im.shape[:2] == tuple(hw) else cv2.resize(im, hw[::-1], interpolation=cv2.INTER_LINEAR)
+
+    def _resize_pair(self, im_rgb, im_ir, hw0, rect_mode=True):
+        """Resizes an RGB/IR pair to the shape computed once from RGB hw0, returns (im_rgb, im_ir, hw0, hw)."""
+        hw = self._resized_shape(*hw0, rect_mode)  # shared by RGB and IR
+        return self._resize(im_rgb, hw), self._resize(im_ir, hw), hw0, hw
+
+    def _read_blob(self, blob, blob_hw, i, rect_mode=True):
+        """Reads image 'i' from a packed disk cache, returns (im, hw_original, hw_resized)."""
+        r = self.blob_rows[i]
+        h0, w0, h, w = blob_hw[r].tolist()
+        im = blob[r, :h, :w]  # zero-copy view of the memory-mapped cache
+        if not rect_mode:  # cache is stored long-side resized, stretch to square imgsz
+            im = self._resize(im, (self.imgsz, self.imgsz))
+        return im, (h0, w0), im.shape[:2]
+
+    def cache_images(self, cache):
+        """Cache RGB and IR image pairs to memory or disk in a single thread pool."""
         b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-        fcn = self.cache_images_to_disk_ir if cache == "disk" else self.load_image_ir
+        if cache == "disk":
+            order = sorted(range(self.ni), key=self.im_files_rgb.__getitem__)  # rows in file order, rect independent
+            self.blob_rows = np.empty(self.ni, np.int64)
+            self.blob_rows[order] = np.arange(self.ni)
+            files = [[x[j] for j in order] for x in (self.im_files_rgb, self.im_files_ir)]
+            hashes = get_hash(files[0]), get_hash(files[1])  # change with the image set, e.g. fraction
+            self.blob_file_rgb, self.blob_file_ir = (
+                Path(x[0]).parent.with_suffix(f".{m}{self.imgsz}.{h[:16]}.bin")
+                for m, x, h in zip(("rgb", "ir"), files, hashes)
+            )
+            if self.load_disk_cache(hashes):
+                return
+            if not (is_dir_writeable(self.blob_file_rgb.parent) and is_dir_writeable(self.blob_file_ir.parent)):
+                LOGGER.warning(f"{self.prefix_rgb}WARNING ⚠️ Cache directory is not writeable, images not cached.")
+                return
+            shape = (self.ni, self.imgsz, self.imgsz, 3)
+            tmp_files = [f.with_name(f"{f.name}.{os.getpid()}.tmp") for f in (self.blob_file_rgb, self.blob_file_ir)]
+            self.blob_rgb, self.blob_ir = (np.memmap(f, dtype=np.uint8, mode="w+", shape=shape) for f in tmp_files)
+            self.blob_hw_rgb, self.blob_hw_ir = np.zeros((self.ni, 4), np.int32), np.zeros((self.ni, 4), np.int32)
+        else:  # 'ram'
+            self._alloc_slots()  # before the pool, threads write their own slots
         with ThreadPool(NUM_THREADS) as pool:
-            results = pool.imap(fcn, range(self.ni))
-            pbar = TQDM(enumerate(results), total=self.ni, disable=LOCAL_RANK > 0)
+            results = pool.imap_unordered(partial(self._cache_one, cache), range(self.ni))
+            pbar = TQDM(results, total=self.ni, disable=LOCAL_RANK > 0)
             for i, x in pbar:
-                if cache == "disk":
-                    b += self.npy_files_ir[i].stat().st_size
-                else:  # 'ram'
-                    self.ims_ir[i], self.im_hw0_ir[i], self.im_hw_ir[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    b += self.ims_ir[i].nbytes
-                pbar.desc = f"{self.prefix_ir}Caching images ({b / gb:.1f}GB {cache})"
+                b += x  # bytes written
+                if cache == "ram":
+                    self.slots[i] = i
+                    if self.augment:
+                        self.buffer.append(i)  # mosaic candidates, deque drops the oldest without evicting RAM
+                pbar.desc = f"{self.prefix_rgb}{self.prefix_ir}Caching images ({b / gb:.1f}GB {cache})"
             pbar.close()
-
-    def cache_images_to_disk_ir(self, i):
-        """Saves an image as an *.npy file for faster loading."""
-        f = self.npy_files_ir[i]
-        if not f.exists():
-            np.save(f.as_posix(), cv2.imread(self.im_files_ir[i]), allow_pickle=False)
+        if cache == "disk":
+            self.save_disk_cache(hashes, tmp_files)
+
+    def _cache_one(self, cache, i):
+        """Decodes, resizes and stores pair 'i' into the packed disk cache or its RAM slot, returns (i, bytes)."""
+        im_rgb, im_ir, hw0, (h, w) = self._resize_pair(*self._read_pair(i, self.imgsz))
+        if cache == "disk":
+            r = self.blob_rows[i]
+            self.blob_rgb[r, :h, :w], self.blob_ir[r, :h, :w] = im_rgb, im_ir
+            self.blob_hw_rgb[r] = self.blob_hw_ir[r] = (*hw0, h, w)
+        else:  # 'ram', slot i is reserved for index i
+            self._store(i, im_rgb, im_ir, hw0, (h, w))
+        return i, im_rgb.nbytes + im_ir.nbytes
+
+    def load_disk_cache(self, hashes):
+        """Memory-maps existing packed *.bin disk caches matching the RGB and IR hashes, returns True on success."""
+        hws = []
+        try:
+            for f, h in zip((self.blob_file_rgb, self.blob_file_ir), hashes):
+                with np.load(f.with_suffix(".npz")) as x:  # index of (h0, w0, h, w) per image
+                    assert str(x["hash"]) == h and x["hw"].shape == (self.ni, 4)
+                    hws.append(x["hw"])
+            self._map_blobs()
+        except (FileNotFoundError, AssertionError, KeyError, ValueError, OSError, EOFError, zipfile.BadZipFile):
+            self.blob_rgb, self.blob_hw_rgb, self.blob_ir, self.blob_hw_ir = None, None, None, None
+            return False
+        self.blob_hw_rgb, self.blob_hw_ir = hws
+        return True
+
+    def _map_blobs(self):
+        """Memory-maps the packed disk caches copy-on-write, the files are never modified."""
+        shape = (self.ni, self.imgsz, self.imgsz, 3)
+        self.blob_rgb = np.memmap(self.blob_file_rgb, dtype=np.uint8, mode="c", shape=shape)
+        self.blob_ir = np.memmap(self.blob_file_ir, dtype=np.uint8, mode="c", shape=shape)
+
+    def save_disk_cache(self, hashes, tmp_files):
+        """Moves the written tmp files onto the packed *.bin caches, then writes the *.npz index marking them done."""
+        self.blob_rgb.flush()
+        self.blob_ir.flush()
+        self.blob_rgb, self.blob_ir = None, None  # unmap before the move, required on Windows
+        for f, tmp, h, hw, prefix in (
+            (self.blob_file_rgb, tmp_files[0], hashes[0], self.blob_hw_rgb, self.prefix_rgb),
+            (self.blob_file_ir, tmp_files[1], hashes[1], self.blob_hw_ir, self.prefix_ir),
+        ):
+            os.replace(tmp, f)  # atomic, datasets still mapping a previous file keep reading it unchanged
+            tmp = f.with_name(f"{f.stem}.{os.getpid()}.tmp.npz")  # np.savez() appends .npz to other suffixes
+            np.savez(tmp, hw=hw, hash=h)
+            os.replace(tmp, f.with_suffix(".npz"))  # written last and atomically, a complete index marks a valid cache
+            LOGGER.info(f"{prefix}New image cache created: {f}")
+            stale = re.compile(re.escape(f.name.rsplit(".", 2)[0]) + r"(\.[0-9a-f]{16})?\.(bin|npz)")  # same imgsz
+            for x in f.parent.iterdir():
+                if stale.fullmatch(x.name) and x.stem != f.stem:  # superseded image set, or pre-hash naming
+                    with contextlib.suppress(OSError):  # e.g. still mapped on Windows
+                        x.unlink()
+                        LOGGER.info(f"{prefix}Removed stale image cache: {x}")
+        self.load_disk_cache(hashes)  # re-open read-only (copy-on-write)
 
     def check_cache_ram(self, safety_margin=0.5):
         """Check image caching requirements vs available memory."""
         b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
-        n = min(self.ni, 30)  # extrapolate from 30 random images
-        for _ in range(n):
-            im = cv2.imread(random.choice(self.im_files_rgb))  # sample image
-            ratio = self.imgsz / max(im.shape[0], im.shape[1])  # max(h, w)  # ratio
-            b += im.nbytes * ratio**2
+        n = min(self.ni, 30)  # extrapolate from 30 random image pairs
+        files = [f for i in random.sample(range(self.ni), n) for f in (self.im_files_rgb[i], self.im_files_ir[i])]
+        with ThreadPool(NUM_THREADS) as pool:
+            sizes = pool.map(self._imsize, files)  # read (w, h) from headers, no decode
+        for w, h in sizes:
+            ratio = self.imgsz / max(h, w)  # ratio
+            b += h * ratio * self.imgsz * 3  # bytes of the full-width slot rows spanned by the resized BGR image
         mem_required = b * self.ni / n * (1 + safety_margin)  # GB required to cache dataset into RAM
         mem = psutil.virtual_memory()
         cache = mem_required * 2 < mem.available  # to cache or not to cache, that is the question
@@ -310,52 +428,50 @@ class BaseDataset_m(Dataset):
         bi = np.floor(np.arange(self.ni) / self.batch_size).astype(int)  # batch index
         nb = bi[-1] + 1  # number of batches
 
-        s = np.array([x.pop("shape") for x in self.labels_rgb])  # hw
+        s = np.array([x["shape"] for x in self.labels_rgb])  # hw, dropped from samples by clone_label()
         ar = s[:, 0] / s[:, 1]  # aspect ratio
-        irect = ar.argsort()
+        irect = ar.argsort()  # one permutation for both modalities, IR is resized to its RGB pair
         self.im_files_rgb = [self.im_files_rgb[i] for i in irect]
         self.labels_rgb = [self.labels_rgb[i] for i in irect]
-        ar = ar[irect]
-
-        s = np.array([x.pop("shape") for x in self.labels_ir])  # hw
-        ar = s[:, 0] / s[:, 1]  # aspect ratio
-        irect = ar.argsort()
         self.im_files_ir = [self.im_files_ir[i] for i in irect]
         self.labels_ir = [self.labels_ir[i] for i in irect]
         ar = ar[irect]
 
         # Set training image shapes
-        shapes = [[1, 1]] * nb
-        for i in range(nb):
-            ari = ar[bi == i]
-            mini, maxi = ari.min(), ari.max()
-            if maxi < 1:
-                shapes[i] = [maxi, 1]
-            elif mini > 1:
-                shapes[i] = [1, 1 / mini]
-
-        self.batch_shapes = np.ceil(np.array(shapes) * self.imgsz / self.stride + self.pad).astype(int) * self.stride
+        starts = np.arange(0, self.ni, self.batch_size)  # first image of each batch
+        mini, maxi = np.minimum.reduceat(ar, starts), np.maximum.reduceat(ar, starts)  # per-batch aspect ratio range
+        shapes = np.ones((nb, 2))
+        shapes[maxi < 1, 0] = maxi[maxi < 1]  # all landscape (h < w), [maxi, 1]
+        shapes[mini > 1, 1] = 1 / mini[mini > 1]  # all portrait (h > w), [1, 1 / mini]
+
+        self.batch_shapes = np.ceil(shapes * self.imgsz / self.stride + self.pad).astype(int) * self.stride
         self.batch = bi  # batch index of image
 
     def __getitem__(self, index):
         """Returns transformed label information for given index."""
-        return self.transforms(self.get_image_and_label(index))
+        label = self.get_image_and_label(index)
+        self._prefetch_next(index)  # overlap the next read with this sample's transforms
+        return self.transforms(label)
 
     def get_image_and_label(self, index):
         """Get and return label information from the dataset."""
-        label = deepcopy(self.labels_rgb[index])  # requires deepcopy() https://github.com/ultralytics/ultralytics/pull/1948
-        label['im_file_ir'] = deepcopy(self.labels_ir[index]['im_file_ir'])
-        label.pop("shape", None)  # shape is for rect, remove it
-        label["img_rgb"], label["ori_shape"], label["resized_shape"] = self.load_image_rgb(index)
-        label['img_ir'], _, _ = self.load_image_ir(index)
-        label["ratio_pad"] = (
-            label["resized_shape"][0] / label["ori_shape"][0],
-            label["resized_shape"][1] / label["ori_shape"][1],
-        )  # for evaluation
+        label = self.clone_label(self.labels_rgb[index])  # requires copy, see ultralytics/ultralytics PR 1948
+        label["im_file_ir"] = self.labels_ir[index]["im_file_ir"]
+        label["img_rgb"], label["img_ir"], hw0, hw = self.load_pair(index)  # one shape pair shared by RGB and IR
+        label["ori_shape"], label["resized_shape"] = hw0, hw
+        label["ratio_pad"] = (hw[0] / hw0[0], hw[1] / hw0[1])  # for evaluation
         if self.rect:
             label["rect_shape"] = self.batch_shapes[self.batch[index]]
         return self.update_labels_info(label)
 
+    @staticmethod
+    def clone_label(label):
+        """Copies a label dict without deepcopy(), only ndarray fields are mutable and the rect 'shape' is dropped."""
+        label = {k: v.copy() if isinstance(v, np.ndarray) else v for k, v in label.items() if k != "shape"}
+        if label.get("segments"):
+            label["segments"] = [x.copy() for x in label["segments"]]
+        return label
+
     def __len__(self):
         """Returns the length of the labels list for the dataset."""
         return len(self.labels_rgb)
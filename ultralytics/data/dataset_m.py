@@ -1,5 +1,6 @@
 # Ultralytics YOLO 🚀, AGPL-3.0 license
 import contextlib
+import os
 from itertools import repeat
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
@@ -372,7 +373,7 @@ class ClassificationDataset(torchvision.datasets.ImageFolder):
         self.cache_ram = args.cache is True or args.cache == "ram"  # cache images into RAM
         self.cache_disk = args.cache == "disk"  # cache images on hard drive as uncompressed *.npy files
         self.samples = self.verify_images()  # filter out bad images
-        self.samples = [list(x) + [Path(x[0]).with_suffix(".npy"), None] for x in self.samples]  # file, index, npy, im
+        self.samples = [list(x) + [os.path.splitext(x[0])[0] + ".npy", None] for x in self.samples]  # file, i, npy, im
         scale = (1.0 - args.scale, 1.0)  # (0.08, 1.0)
         self.torch_transforms = (
             classify_augmentations(
@@ -396,8 +397,8 @@ class ClassificationDataset(torchvision.datasets.ImageFolder):
         if self.cache_ram and im is None:
             im = self.samples[i][3] = cv2.imread(f)
         elif self.cache_disk:
-            if not fn.exists():  # load npy
-                np.save(fn.as_posix(), cv2.imread(f), allow_pickle=False)
+            if not os.path.exists(fn):  # load npy
+                np.save(fn, cv2.imread(f), allow_pickle=False)
             im = np.load(fn)
         else:  # read image
             im = cv2.imread(f)  # BGR
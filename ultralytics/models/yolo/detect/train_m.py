@@ -56,8 +56,8 @@ class DetectionTrainer_m(BaseTrainer_m):
 
     def preprocess_batch(self, batch):
         """Preprocesses a batch of images by scaling and converting to float."""
-        batch["img_rgb"] = batch["img_rgb"].to(self.device, non_blocking=True).float() / 255
-        batch["img_ir"] = batch["img_ir"].to(self.device, non_blocking=True).float() / 255
+        batch["img_rgb"] = batch["img_rgb"].to(self.device, non_blocking=True).float().div_(255)
+        batch["img_ir"] = batch["img_ir"].to(self.device, non_blocking=True).float().div_(255)
         if self.args.multi_scale:
             imgs_rgb = batch["img_rgb"]
             imgs_ir = batch["img_ir"]
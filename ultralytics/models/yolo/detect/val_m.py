@@ -43,11 +43,11 @@ class DetectionValidator_m(BaseValidator_m):
     def preprocess(self, batch):
         """Preprocesses batch of images for YOLO training."""
         batch["img_rgb"] = batch["img_rgb"].to(self.device, non_blocking=True)
-        batch["img_rgb"] = (batch["img_rgb"].half() if self.args.half else batch["img_rgb"].float()) / 255
+        batch["img_rgb"] = (batch["img_rgb"].half() if self.args.half else batch["img_rgb"].float()).div_(255)
         batch["img_ir"] = batch["img_ir"].to(self.device, non_blocking=True)
-        batch["img_ir"] = (batch["img_ir"].half() if self.args.half else batch["img_ir"].float()) / 255
+        batch["img_ir"] = (batch["img_ir"].half() if self.args.half else batch["img_ir"].float()).div_(255)
         for k in ["batch_idx", "cls", "bboxes"]:
-            batch[k] = batch[k].to(self.device)
+            batch[k] = batch[k].to(self.device, non_blocking=True)
 
         if self.args.save_hybrid:
             height, width = batch["img_rgb"].shape[2:]